@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Start-up latency of py3line.py for a few typical one-liners on a tiny input.
+
+Every one-liner is measured with and without the compiled code cache, next
+to a bare `python -c pass` run, so the py3line own cost is easy to see::
+
+    $ python benchmarks/startup.py --runs 30
+    $ python benchmarks/startup.py --json > startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PY3LINE = os.path.join(ROOT, 'py3line.py')
+INPUT = b'Here are\nsome\nwords for you.\n'
+ONE_LINERS = [
+    ['print(line)'],
+    ['x = len(line.split()); print(x, line)'],
+    ['line = len(line.split()); print(sum(stream))'],
+    ["print(re.findall(r'\\w+', line))"],
+    ['line = json.dumps(line.split()); print(line)'],
+]
+
+
+def measure(command, runs, env):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, input=INPUT, stdout=subprocess.DEVNULL, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return {'median_ms': statistics.median(timings) * 1000, 'min_ms': min(timings) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='runs per command (default: %(default)s)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, PY3LINE_CACHE_DIR=cache_dir)
+        results = {
+            'python': sys.version.split()[0],
+            'interpreter': measure([sys.executable, '-c', 'pass'], args.runs, env),
+            'one_liners': [],
+        }
+        for expressions in ONE_LINERS:
+            command = [sys.executable, PY3LINE] + expressions
+            results['one_liners'].append({
+                'expressions': expressions,
+                'no_cache': measure(command + ['--no-cache'], args.runs, env),
+                'cached': measure(command, args.runs, env),
+            })
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print('python -c pass: {median_ms:7.2f} ms'.format(**results['interpreter']))
+    print('{:>10} {:>10}  expressions'.format('no-cache', 'cached'))
+    for result in results['one_liners']:
+        print('{:7.2f} ms {:7.2f} ms  {}'.format(
+            result['no_cache']['median_ms'], result['cached']['median_ms'], '; '.join(result['expressions'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,36 +6,109 @@
 # updated 2019.05.01, thanks to Pahaz White (v0.2.0)
 # updated 2019.05.05, thanks to Pahaz White (v0.3.0)
 
-import ast
-from pprint import pprint
+# Only cheap modules are imported here. `ast`, `argparse` and `logging` are
+# imported when they are needed, that is not done for a cached pipeline.
 from collections import namedtuple, deque
-from enum import Enum
 import sys, os
-import logging
-import argparse
-import tempfile
-import traceback
+import builtins
+import binascii
+import mmap
+import itertools
+import stat
+import marshal
 
 __version__ = '0.3.1'
 NAME = 'py3line'
-LOGGER = logging.getLogger(NAME)
 DEFAULT_MODULES = {
     'os', 'sys', 'types', 're', 'shlex', 'shutil', 'pathlib', 
     'operator', 'collections', 'itertools', 'functools', 
     'json', 'base64', 'random', 'time', 'subprocess'}
-ActionTypes = Enum('ActionTypes', 'stream, element')
-Action = namedtuple('Action', 'string, warns, type, group')
+BLOCK_SIZE = 1 << 20
+OUTPUT_BUFFER_SIZE = 1 << 18
+PARALLEL_BATCH_SIZE = 1024
+BATCH_SIZE = 1024
+SORT_MEMORY = 1 << 28
+SORT_MERGE_WIDTH = 64
+READ_AHEAD = 2
+PREFETCH_BLOCKS = 4
+MAX_LINE_SIZE = 1 << 24
+FOLLOW_TIMEOUT = 1.0
+SOURCE_NAME = '<string>'
+CACHE_DIR = os.environ.get('PY3LINE_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), NAME)
+CACHE_SIZE = 1 << 23
+# loop invariant calls of the optimizer: `re` functions with the max number
+# of positional arguments that the compiled pattern methods accept the same way
+RE_FUNCTIONS = {
+    'match': 2, 'fullmatch': 2, 'search': 2, 'findall': 2, 'finditer': 2,
+    'split': 3, 'sub': 4, 'subn': 4}
+PURE_FUNCTIONS = {
+    ('re', 'compile'), ('str', 'maketrans'), ('bytes', 'maketrans'),
+    ('operator', 'itemgetter'), ('operator', 'attrgetter')}
+class ActionTypes:
+    stream = 'stream'
+    batch = 'batch'
+    element = 'element'
+Action = namedtuple('Action', 'string, warns, type, group, tokens, def_names, used_names')
 class Py3LineSyntaxError(SyntaxError): pass
 
 if sys.version_info[0] != 3:
     raise RuntimeError("Only python 3.x is supported")
 
-class _MyNodeVisitor(ast.NodeVisitor):
+class _Logger:
+    """Stand-in for `logging.getLogger(NAME)`. Imports `logging` on the first shown message."""
+    DEBUG, WARNING, ERROR, CRITICAL = 10, 30, 40, 50
+
     def __init__(self):
+        self.level = self.WARNING
+        self._logger = None
+
+    def _log(self, level, msg, args):
+        if level < self.level:
+            return
+        if self._logger is None:
+            import logging
+            self._logger = logging.getLogger(NAME)
+            if not self._logger.handlers:  # if no handlers, add a new one (console)
+                console_handler = logging.StreamHandler()
+                console_handler.setLevel(logging.DEBUG)
+                console_handler.setFormatter(
+                    logging.Formatter('%(asctime)s | %(levelname)-8s| %(message)s')
+                )
+                self._logger.addHandler(console_handler)
+            self._logger.setLevel(self.DEBUG)
+
+            # capture_warnings
+            logging.captureWarnings(True)
+            pywarnings = logging.getLogger('py.warnings')
+            pywarnings.handlers.extend(self._logger.handlers)
+        self._logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self._log(self.DEBUG, msg, args)
+
+    def warning(self, msg, *args):
+        self._log(self.WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self._log(self.ERROR, msg, args)
+
+LOGGER = _Logger()
+
+class _MyNodeVisitor:
+    # the `ast.NodeVisitor` protocol, but `ast` is imported only when something is parsed
+    def __init__(self):
+        from enum import Enum
         self.NameTypes = Enum('NameTypes', 'module, function')
         self.NameContext = namedtuple('NameContext', 'type, use_names, def_names, local_names')
         self._name_contexts = [self.NameContext(self.NameTypes.module, set(), set(), set())]
         self._current_names = self._name_contexts[-1].use_names
+    def visit(self, node):
+        visitor = getattr(self, 'visit_' + node.__class__.__name__, self.generic_visit)
+        return visitor(node)
+    def generic_visit(self, node):
+        import ast
+        ast.NodeVisitor.generic_visit(self, node)
     def visit_Name(self, node):
         self._current_names.add(node.id)
     def visit_FunctionDef(self, node):
@@ -44,9 +117,6 @@ class _MyNodeVisitor(ast.NodeVisitor):
         raise Py3LineSyntaxError('`async def` is not allowed to use')
     def visit_ClassDef(self, node):
         raise Py3LineSyntaxError('`class` is not allowed to use')
-    def visit_arguments(self, node):
-        print(ast.dump(node))
-        self.generic_visit(node)
     def visit_arg(self, node):
         current_local_names = self._name_contexts[-1].local_names
         current_local_names.add(node.arg)
@@ -101,7 +171,103 @@ class _MyNodeVisitor(ast.NodeVisitor):
     def visit_Await(self, node):
         raise Py3LineSyntaxError('`await` is not allowed to use')
 
+class _Hoister:
+    """Replaces loop invariant sub-expressions of actions by names computed once per group.
+
+    Invariant are constants, attributes of not reassigned default modules,
+    `PURE_FUNCTIONS` calls of them and compiled patterns of `re` functions.
+    """
+    # the `ast.NodeTransformer` protocol, `ast` is imported only when it is needed
+    def __init__(self, assigned):
+        self.assigned = assigned
+        self.hoisted = {}
+        self.changed = False
+    def visit(self, node):
+        visitor = getattr(self, 'visit_' + node.__class__.__name__, self.generic_visit)
+        return visitor(node)
+    def generic_visit(self, node):
+        import ast
+        return ast.NodeTransformer.generic_visit(self, node)
+    def _module_attr(self, node):
+        import ast
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.value.id not in self.assigned):
+            return node.value.id, node.attr
+        return None
+    def _is_invariant(self, node):
+        import ast
+        if isinstance(node, ast.Constant):
+            return True
+        if isinstance(node, ast.Attribute):
+            module_attr = self._module_attr(node)
+            return module_attr is not None and module_attr[0] in DEFAULT_MODULES
+        if isinstance(node, ast.BinOp):
+            return self._is_invariant(node.left) and self._is_invariant(node.right)
+        if isinstance(node, ast.UnaryOp):
+            return self._is_invariant(node.operand)
+        if isinstance(node, ast.Tuple):
+            return all(map(self._is_invariant, node.elts))
+        return False
+    def _hoist(self, node, prefix):
+        import ast
+        source = ast.unparse(node)
+        if source not in self.hoisted:
+            self.hoisted[source] = '_{}{}'.format(prefix, len(self.hoisted) + 1)
+        self.changed = True
+        return ast.Name(id=self.hoisted[source], ctx=ast.Load())
+    def visit_Call(self, node):
+        import ast
+        node = self.generic_visit(node)
+        func = self._module_attr(node.func)
+        arguments = node.args + [kw.value for kw in node.keywords]
+        if func in PURE_FUNCTIONS and all(map(self._is_invariant, arguments)):
+            return self._hoist(node, 're' if func[0] == 're' else 'const')
+        if (func and func[0] == 're' and func[1] in RE_FUNCTIONS
+                and 2 <= len(node.args) <= RE_FUNCTIONS[func[1]]
+                and not any(isinstance(x, ast.Starred) for x in node.args)
+                and self._is_invariant(node.args[0])):
+            flags = [kw.value for kw in node.keywords if kw.arg == 'flags']
+            keywords = [kw for kw in node.keywords if kw.arg != 'flags']
+            if any(kw.arg is None for kw in keywords) or not all(map(self._is_invariant, flags)):
+                return node
+            pattern = ast.Call(
+                func=ast.Attribute(value=ast.Name(id='re', ctx=ast.Load()), attr='compile', ctx=ast.Load()),
+                args=node.args[:1] + flags, keywords=[])
+            method = ast.Attribute(value=self._hoist(pattern, 're'), attr=func[1], ctx=ast.Load())
+            return ast.Call(func=method, args=node.args[1:], keywords=keywords)
+        return node
+    def _is_invariant_dict(self, node):
+        import ast
+        return (isinstance(node, ast.Dict) and None not in node.keys
+                and all(map(self._is_invariant, node.keys + node.values)))
+    def visit_Subscript(self, node):
+        node = self.generic_visit(node)
+        # a lookup in a constant dict display, like `{'a': 1, 'b': 2}[line]`
+        if self._is_invariant_dict(node.value):
+            node.value = self._hoist(node.value, 'const')
+        return node
+    def visit_Attribute(self, node):
+        node = self.generic_visit(node)
+        if node.attr == 'get' and self._is_invariant_dict(node.value):
+            node.value = self._hoist(node.value, 'const')
+        return node
+
+def _hoist_invariants(group, variables):
+    import ast
+    if not hasattr(ast, 'unparse'):  # python < 3.9
+        return group, {}
+    hoister = _Hoister(variables | {'line', 'stream'})
+    optimized = []
+    for action in group:
+        hoister.changed = False
+        tokens = hoister.visit(action.tokens)
+        if hoister.changed:
+            action = action._replace(string=ast.unparse(tokens), tokens=tokens)
+        optimized.append(action)
+    return optimized, hoister.hoisted
+
 def to_tokens(expr):
+    import ast
     res = ast.parse(expr + '\n', mode='exec').body
     if len(res) != 1:
         raise Py3LineSyntaxError('unexpected multyline')
@@ -112,7 +278,8 @@ def get_names(tokens):
     v.visit(tokens)
     return v._name_contexts[-1].def_names, v._name_contexts[-1].use_names, v._name_contexts[-1].local_names
 
-def parseargs():
+def parseargs(argv=None):
+    import argparse
     description = (
         "Py3line is a UNIX command-line tool for a simple text stream "
         "processing by the Python one-liner scripts. Like grep, sed and awk."
@@ -140,31 +307,93 @@ def parseargs():
                         action='store_true',
                         help='show generated python code')
 
-    return parser.parse_args()
+    parser.add_argument('-i', '--input',
+                        dest='inputs', metavar='FILE',
+                        action='append', nargs='+',
+                        help='read FILEs instead of stdin, gzip, bzip2 and xz files are decompressed; '
+                             'put expressions before it or after `--`')
 
-def setup_logger(args):
-    if not LOGGER.handlers:  # if no handlers, add a new one (console)
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        console_handler.setFormatter(
-            logging.Formatter('%(asctime)s | %(levelname)-8s| %(message)s')
-        )
-        LOGGER.addHandler(console_handler)
+    parser.add_argument('-f', '--follow',
+                        dest='follow',
+                        action='store_true',
+                        help='output new lines of the -i FILEs as they are appended, like `tail -n 0 -F`; '
+                             'also flush output on every line')
+    parser.add_argument('--max-line-size',
+                        dest='max_line_size', metavar='CHARS',
+                        type=int, default=MAX_LINE_SIZE,
+                        help='with --follow, split longer lines (default: %(default)s)')
+
+    parser.add_argument('--jsonl',
+                        dest='jsonl',
+                        action='store_true',
+                        help='JSON lines mode: decode lines to the `record` variable, skip malformed lines; '
+                             '`emit(obj)` writes a JSON line')
+
+    parser.add_argument('-F', '--field-separator',
+                        dest='field_separator', metavar='SEP',
+                        help='split lines to the `fields` variable by SEP, like awk '
+                             '(default: whitespace, a longer than one char SEP is a regex)')
+
+    parser.add_argument('--serve',
+                        dest='serve', metavar='SOCKET',
+                        help='run a daemon on the SOCKET Unix socket, '
+                             'py3line runs in it if the PY3LINE_SOCKET environment variable is SOCKET')
+
+    parser.add_argument('--no-cache',
+                        dest='cache',
+                        action='store_false',
+                        help='do not use the compiled code cache')
+
+    parser.add_argument('-j', '--jobs',
+                        dest='jobs', metavar='N',
+                        type=int, default=1,
+                        help='process line actions in N worker processes, 0 is the number of CPUs')
+
+    parser.add_argument('--batch-size',
+                        dest='batch_size', metavar='N',
+                        type=int, default=BATCH_SIZE,
+                        help='number of lines in the `batch` variable (default: %(default)s)')
+    parser.add_argument('--numpy',
+                        dest='numpy',
+                        action='store_true',
+                        help='make `batch` a NumPy array, if NumPy is installed')
+
+    parser.add_argument('--sort-memory',
+                        dest='sort_memory', metavar='BYTES',
+                        type=int, default=SORT_MEMORY,
+                        help='memory budget of sort() and group_by(), '
+                             'they spill to temporary files above it (default: %(default)s)')
 
+    parser.add_argument('--buffer-size',
+                        dest='buffer_size', metavar='BYTES',
+                        type=int, default=OUTPUT_BUFFER_SIZE,
+                        help='output buffer size (default: %(default)s)')
+    parser.add_argument('--line-buffered',
+                        dest='line_buffered',
+                        action='store_true',
+                        help='flush output on every line (default: only if stdout is a tty)')
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store_const', const='text',
+                        help='print time and call counts of every action to stderr at exit')
+    parser.add_argument('--profile-json',
+                        dest='profile',
+                        action='store_const', const='json',
+                        help='like --profile, but print the statistics as JSON')
+
+    return parser.parse_args(argv)
+
+def setup_logger(args):
     if args.quiet:
-        LOGGER.setLevel(logging.CRITICAL)
+        LOGGER.level = LOGGER.CRITICAL
     else:
         if args.verbose:
-            LOGGER.setLevel(logging.DEBUG)
+            LOGGER.level = LOGGER.DEBUG
         else:
-            LOGGER.setLevel(logging.WARN)
-
-    # capture_warnings
-    logging.captureWarnings(True)
-    pywarnings = logging.getLogger('py.warnings')
-    pywarnings.handlers.extend(LOGGER.handlers)
+            LOGGER.level = LOGGER.WARNING
 
-def _preprocess_expressions(exprs):
+def _preprocess_expressions(exprs, jsonl=False):
     actions = []
     variables = set()
     used_variables = set()
@@ -173,7 +402,8 @@ def _preprocess_expressions(exprs):
     prev_type = ActionTypes.stream
     
     stream_markers = {'stream'}
-    element_markers = {'line'}
+    batch_markers = {'batch'}
+    element_markers = {'line', 'fields', 'record'} if jsonl else {'line', 'fields'}
 
     for expr in exprs:
         if not expr:
@@ -186,9 +416,12 @@ def _preprocess_expressions(exprs):
         warns = []
 
         has_stream_marker = (def_names | used_names) & stream_markers
+        has_batch_marker = (def_names | used_names) & batch_markers
         has_element_marker = (def_names | used_names) & element_markers
         if has_stream_marker:
             current_type = ActionTypes.stream
+        elif has_batch_marker:
+            current_type = ActionTypes.batch
         elif has_element_marker:
             current_type = ActionTypes.element
         else:
@@ -199,15 +432,81 @@ def _preprocess_expressions(exprs):
 
         LOGGER.debug('action: %r, warns=%r, type=%s, group=%r, def_names=%r', 
                      expr, warns, current_type, group, def_names)
-        actions.append(Action(expr, warns, current_type, group))
+        actions.append(Action(expr, warns, current_type, group, tokens, def_names, used_names))
         prev_type = current_type
 
     return actions, variables, used_variables
 
-def _codegen(actions, variables: set, used_variables: set, modules: set) -> str:
+def _split_groups(actions):
+    groups = []
+    for action in actions:
+        if not groups or groups[-1][-1].group != action.group:
+            groups.append([])
+        groups[-1].append(action)
+    return groups
+
+def _shared_names(groups, variables):
+    """Variables used by more than one group. Others stay in fast function locals."""
+    counts = {}
+    for group in groups:
+        for name in set().union(*(a.def_names | a.used_names for a in group)) & variables:
+            counts[name] = counts.get(name, 0) + 1
+    return {name for name, count in counts.items() if count > 1}
+
+def _has_yield(group):
+    import ast
+    return any(isinstance(node, (ast.Yield, ast.YieldFrom))
+               for action in group for node in ast.walk(action.tokens))
+
+def _has_jump(action):
+    import ast
+    return any(isinstance(node, (ast.Continue, ast.Break, ast.Return)) for node in ast.walk(action.tokens))
+
+def _is_index(node):
+    import ast
+    return isinstance(node, ast.Constant) and type(node.value) is int and node.value >= 0
+
+def _fields_maxsplit(group):
+    """The number of leading `fields` used by constant indexes, or None if all fields may be used."""
+    import ast
+    need = names = subscripts = 0
+    for action in group:
+        for node in ast.walk(action.tokens):
+            if isinstance(node, ast.Name) and node.id == 'fields':
+                names += 1
+            elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'fields':
+                index = node.slice.value if type(node.slice).__name__ == 'Index' else node.slice  # python < 3.9
+                if _is_index(index):
+                    need = max(need, index.value + 1)
+                elif (isinstance(index, ast.Slice) and index.step is None and _is_index(index.upper)
+                        and (index.lower is None or _is_index(index.lower))):
+                    need = max(need, index.upper.value)
+                else:
+                    return None
+                subscripts += 1
+    return need if names == subscripts else None
+
+def _fields_codegen(group, separator):
+    """Returns the statements before the group loop and the `fields` split statement."""
+    maxsplit = _fields_maxsplit(group)
+    if separator is not None and len(separator) > 1:
+        return ['_fs = re.compile({!r})'.format(separator)], 'fields = _fs.split(line, {})'.format(maxsplit or 0)
+    if maxsplit is None:
+        return [], 'fields = line.split({})'.format('' if separator is None else repr(separator))
+    return [], 'fields = line.split({!r}, {})'.format(separator, maxsplit)
+
+def _codegen(actions, variables: set, used_variables: set, modules: set, args=None) -> str:
     if not actions:
         return ''
-    variables = ", ".join(sorted(variables - {'stream', 'line'}))
+    args = args or parseargs([])
+    groups = _split_groups(actions)
+    all_variables = variables
+    shared_names = _shared_names(groups, variables - {'stream', 'batch', 'line', 'record'})
+    separator = args.field_separator
+    if separator is not None:
+        separator = separator.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+        if len(separator) > 1 and 'fields' in used_variables:
+            modules = modules | {'re'}
     modules = sorted(modules | DEFAULT_MODULES & used_variables | {'sys'})
     lines = []
 
@@ -215,111 +514,1114 @@ def _codegen(actions, variables: set, used_variables: set, modules: set) -> str:
         lines.append('import {module}'.format(module=module))
     lines.append('')
 
-    prev_type = ActionTypes.stream
-    prev_group = 0
+    # the last element or batch group can loop over the stream itself, without a generator
+    last = groups[-1]
+    loop_last = (last[0].type == ActionTypes.batch
+                 or last[0].type == ActionTypes.element and args.jobs == 1) and not _has_yield(last)
     transforations = deque()
+    profile = args.profile is not None
+    if profile and args.jobs != 1:
+        LOGGER.warning('--profile does not collect action times from worker processes')
+    action_index = itertools.count()
+    profile_groups = []
 
-    for action in actions:
-        if prev_group < action.group:
-            if prev_group:
-                if prev_type == ActionTypes.element:
-                    lines.append('        yield line\n')
-                elif prev_type == ActionTypes.stream:
-                    lines.append('    return stream\n')
-                else:
-                    raise RuntimeError('unexpected!')
-            func_prefix = 'transform' if action.type == ActionTypes.stream else 'process'
-            func_name = '{func_prefix}{action.group}'.format(action=action, func_prefix=func_prefix)
-            lines.append('def {func_name}(stream):'.format(func_name=func_name))
-            transforations.appendleft(func_name)
-            if variables:
-                lines.append('    global {variables}'.format(variables=variables))
-            if action.type == ActionTypes.element:
-                lines.append('    for line in stream:')
-
-        if action.type == ActionTypes.element:
-            lines.append('        {action.string}'.format(action=action))
-        elif action.type == ActionTypes.stream:
-            lines.append('    {action.string}'.format(action=action))
+    def action_lines(indent, action):
+        if not profile:
+            yield indent + action.string
+            return
+        timer = '_t0, _t = _t, _clock(); _ptimes[{0}] += _t - _t0; _pcalls[{0}] += 1'.format(next(action_index))
+        if _has_jump(action):
+            # `continue` and `break` skip the next statement, time it in `finally`
+            yield from (indent + 'try:', indent + '    ' + action.string, indent + 'finally:', indent + '    ' + timer)
         else:
-            raise RuntimeError('unexpected!')
+            yield from (indent + action.string, indent + timer)
 
-        prev_type = action.type
-        prev_group = action.group
+    for group in groups:
+        group_type, group_number = group[0].type, group[0].group
+        func_prefix = {ActionTypes.stream: 'transform', ActionTypes.batch: 'process_batch'}.get(group_type, 'process')
+        func_name = '{func_prefix}{group_number}'.format(func_prefix=func_prefix, group_number=group_number)
+        lines.append('def {func_name}(stream):'.format(func_name=func_name))
+        if group_type == ActionTypes.element and args.jobs != 1:
+            transforations.appendleft('parallel({func_name}, {{}}, jobs={jobs})'.format(
+                func_name=func_name, jobs=args.jobs or os.cpu_count()))
+        else:
+            transforations.appendleft(func_name + '({})')
+        if profile:
+            profile_groups.append((func_name, [action.string for action in group]))
+            if not (group is last and loop_last):
+                transforations.appendleft('_profile.counted({{}}, {!r})'.format(func_name))
+        group_names = set().union(*(a.def_names | a.used_names for a in group))
+        variables = ", ".join(sorted(shared_names & group_names))
+        if variables:
+            lines.append('    global {variables}'.format(variables=variables))
+        is_last = group is last
+        group, hoisted = _hoist_invariants(group, all_variables)
+        for source, name in hoisted.items():
+            lines.append('    {name} = {source}'.format(name=name, source=source))
+        if profile:
+            lines.append('    _clock, _ptimes, _pcalls = _profile.clock, _profile.times, _profile.calls')
 
-    if prev_type == ActionTypes.element:
-        lines.append('        yield line\n')
-    elif prev_type == ActionTypes.stream:
-        lines.append('    return stream\n')
-    else:
-        raise RuntimeError('unexpected!')
+        if group_type == ActionTypes.element:
+            # `fields` is split only if it is used and only before the first action which uses it
+            split_fields = ('fields' in group_names
+                            and not any('fields' in action.def_names for action in group))
+            if split_fields:
+                prelude, fields_statement = _fields_codegen(group, separator)
+                lines.extend('    ' + x for x in prelude)
+            # so is `record` of the --jsonl mode, malformed lines are skipped
+            decode_record = (args.jsonl and 'record' in group_names
+                             and not any('record' in action.def_names for action in group))
+            if decode_record:
+                lines.append('    _loads = _jsonl.loads')
+            lines.append('    for line in stream:')
+            if profile:
+                lines.append('        _t = _clock()')
+            for action in group:
+                if split_fields and 'fields' in action.used_names:
+                    lines.append('        ' + fields_statement)
+                    split_fields = False
+                if decode_record and 'record' in action.used_names:
+                    lines.extend([
+                        '        try:',
+                        '            record = _loads(line)',
+                        '        except ValueError as exc:',
+                        '            _jsonl.skip(line, exc)',
+                        '            continue'])
+                    decode_record = False
+                lines.extend(action_lines('        ', action))
+            lines.append('' if is_last and loop_last else '        yield line\n')
+        elif group_type == ActionTypes.batch:
+            lines.append('    for batch in batches(stream, {size}, array={array}):'.format(
+                size=args.batch_size, array=args.numpy))
+            if profile:
+                lines.append('        _t = _clock()')
+            for action in group:
+                lines.extend(action_lines('        ', action))
+            lines.append('' if is_last and loop_last else '        yield from batch\n')
+        elif group_type == ActionTypes.stream:
+            if profile:
+                lines.append('    _t = _clock()')
+            for action in group:
+                lines.extend(action_lines('    ', action))
+            lines.append('    return stream\n')
+        else:
+            raise RuntimeError('unexpected!')
 
     lines.append('if __name__ == "__main__":')
     if transforations:
-        lines.append('    stream = (line.rstrip("\\r\\n") for line in sys.stdin if line)')
-        funcs = '('.join(transforations) + '(stream' + ')' * len(transforations)
-        lines.append('    stream = {funcs}'.format(funcs=funcs))
-        lines.append('    for line in stream: pass')
+        line_buffered = 'True' if args.line_buffered or args.follow else 'sys.stdout.isatty()'
+        lines.append('    output = Output(sys.stdout, buffer_size={size}, line_buffered={line_buffered})'.format(
+            size=args.buffer_size, line_buffered=line_buffered))
+        lines.append('    print = output.print')
+        if args.jsonl:
+            lines.append('    _jsonl = JsonLines(output)')
+            lines.append('    emit = _jsonl.emit')
+        if args.sort_memory != SORT_MEMORY:
+            lines.append('    SORT_MEMORY = {}'.format(args.sort_memory))
+        if profile:
+            lines.append('    _profile = Profile({!r})'.format(profile_groups))
+            lines.append('    output.flush = _profile.timed_flush(output.flush)')
+        inputs = [path for paths in args.inputs or () for path in paths]
+        reader_args = ', profile=_profile' if profile else ''
+        if inputs and args.follow:
+            lines.append('    stream = follow_files({!r}, max_line_size={}{})'.format(
+                inputs, args.max_line_size, reader_args))
+        elif inputs:
+            lines.append('    stream = read_files({!r}{})'.format(inputs, reader_args))
+        else:
+            if 'filename' in used_variables:
+                lines.append("    filename = '-'")
+            lines.append('    stream = read_lines(sys.stdin{})'.format(reader_args))
+        import functools
+        funcs = functools.reduce(lambda x, call: call.format(x), reversed(transforations), 'stream')
+        lines.append('    try:')
+        if loop_last:
+            lines.append('        {funcs}'.format(funcs=funcs))
+        else:
+            lines.append('        stream = {funcs}'.format(funcs=funcs))
+            lines.append('        for line in stream: pass')
+        lines.append('    finally:')
+        lines.append('        output.flush()')
+        if args.jsonl:
+            lines.append('        _jsonl.report()')
+        if profile:
+            lines.append('        _profile.report(sys.stderr, {!r})'.format(args.profile))
 
     return '\n'.join(lines)
 
-def _try_to_write_to_tmp_py_file(data):
+def _iter_mmap_blocks(fd, offset, block_size):
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        for pos in range(offset, len(mm), block_size):
+            yield mm[pos:pos + block_size]
+
+def _iter_blocks(fp, block_size=BLOCK_SIZE):
+    fd = fp.fileno()
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode):
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        return _iter_mmap_blocks(fd, offset, block_size) if offset < st.st_size else iter(())
+    return iter(lambda: os.read(fd, block_size), b'')
+
+def _split_lines(text):
+    if '\r' in text:  # universal newlines, like the text mode `sys.stdin`
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def _read_line_blocks(fp, block_size):
+    try:
+        blocks = _iter_blocks(fp, block_size)
+        encoding, errors = fp.encoding, fp.errors
+    except (AttributeError, OSError, ValueError) as exc:  # not a real file
+        LOGGER.debug('read_lines() fallback to line iteration: %s', exc)
+        yield from ([line.rstrip("\r\n")] for line in fp if line)
+        return
+    yield from _decode_blocks(blocks, encoding, errors)
+
+def _decode_blocks(blocks, encoding, errors):
+    tail = b''
+    for block in blocks:
+        cut = block.rfind(b'\n') + 1
+        if not cut:
+            tail += block
+            continue
+        yield _split_lines((tail + block[:cut]).decode(encoding, errors))
+        tail = block[cut:]
+    if tail:
+        yield _split_lines(tail.decode(encoding, errors))
+
+def read_lines(fp, block_size=BLOCK_SIZE, profile=None):
+    """Yield lines of `fp` without line endings. Reads by big blocks.
+
+    Regular files are memory-mapped, pipes are read by `os.read()`. Every block
+    is cut by the last newline, decoded and split into lines at once.
+    """
+    blocks = _read_line_blocks(fp, block_size)
+    if profile is not None:
+        blocks = profile.timed_blocks(blocks)
+    return itertools.chain.from_iterable(blocks)
+
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma')]
+
+def _iter_file_blocks(path, block_size):
+    """Yield raw blocks of `path`, decompressed if it starts with gzip, bzip2 or xz magic bytes."""
+    if path == '-':
+        yield from _iter_blocks(sys.stdin, block_size)
+        return
+    with open(path, 'rb') as fp:
+        magic = fp.read(6)
+        module = next((name for prefix, name in COMPRESSION_MAGIC if magic.startswith(prefix)), None)
+        if module is None:
+            fp.seek(0)
+            yield from _iter_blocks(fp, block_size)
+            return
+    import importlib
+    with importlib.import_module(module).open(path, 'rb') as fp:
+        yield from iter(lambda: fp.read(block_size), b'')
+
+def _prefetch(blocks, size):
+    """Start iterating `blocks` in a background thread, up to `size` blocks ahead.
+
+    Decompressors release the GIL, so the next file is decompressed while the
+    current one is processed.
+    """
+    import threading
+    import queue
+    blocks_queue = queue.Queue(size)
+
+    def run():
+        try:
+            for block in blocks:
+                blocks_queue.put((block, None))
+        except BaseException as exc:
+            blocks_queue.put((None, exc))
+        else:
+            blocks_queue.put((None, None))
+
+    threading.Thread(target=run, daemon=True).start()
+    return _iter_queue(blocks_queue)
+
+def _iter_queue(blocks_queue):
+    while True:
+        block, exc = blocks_queue.get()
+        if exc is not None:
+            raise exc
+        if block is None:
+            return
+        yield block
+
+def _read_files_blocks(paths, block_size):
+    global filename
+    encoding, errors = sys.stdin.encoding or 'utf-8', sys.stdin.errors or 'strict'
+    paths = iter(paths)
+    started = deque()
+    while True:
+        # keep READ_AHEAD files read in background, starting from the current one
+        for path in itertools.islice(paths, READ_AHEAD - len(started)):
+            started.append((path, _prefetch(_iter_file_blocks(path, block_size), PREFETCH_BLOCKS)))
+        if not started:
+            return
+        path, blocks = started.popleft()
+        for lines in _decode_blocks(blocks, encoding, errors):
+            # lines of the previous block are already consumed, it is safe to switch the name
+            filename = path
+            yield lines
+
+class _FollowedFile:
+    """A file followed by name like `tail -F`: it is reopened if it is rotated and reread if it is truncated."""
+
+    def __init__(self, path, encoding, errors):
+        import codecs
+        self.path = path
+        self.fd = None
+        self.position = 0
+        self.tail = ''
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        if self._open():
+            self.position = os.lseek(self.fd, 0, os.SEEK_END)
+
+    def _open(self):
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        self.position = 0
+        self.decoder.reset()
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _rotated(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        old = os.fstat(self.fd)
+        return (st.st_dev, st.st_ino) != (old.st_dev, old.st_ino)
+
+    def _end_line(self, text):
+        # an unfinished last line of the old content is a line, do not glue it to the new content
+        text.append(self.decoder.decode(b'', final=True))
+        self.decoder.reset()
+        last = next((part[-1] for part in reversed(text) if part), self.tail[-1:] or '\n')
+        if last != '\n':
+            text.append('\n')
+
+    def read(self, block_size, max_line_size):
+        """Read all the appended text. Returns a list of complete lines."""
+        if self.fd is None and not self._open():
+            return []
+        text = []
+        while True:
+            data = os.pread(self.fd, block_size, self.position)
+            if data:
+                self.position += len(data)
+                text.append(self.decoder.decode(data))
+            elif os.fstat(self.fd).st_size < self.position:
+                LOGGER.warning('%s: file truncated', self.path)
+                self._end_line(text)
+                self.position = 0
+            elif self._rotated():
+                # the rest of the old file is read, continue with the new one
+                LOGGER.warning('%s: file rotated', self.path)
+                self._end_line(text)
+                self.close()
+                self._open()
+            else:
+                break
+            if sum(map(len, text)) > block_size:
+                break
+        text = self.tail + ''.join(text)
+        # keep a trailing '\r', it may be a part of '\r\n'
+        cut = max(text.rfind('\n'), text.rfind('\r', 0, len(text) - 1)) + 1
+        self.tail = text[cut:]
+        lines = _split_lines(text[:cut])
+        while len(self.tail) > max_line_size:
+            lines.append(self.tail[:max_line_size])
+            self.tail = self.tail[max_line_size:]
+        return lines
+
+class _Watcher:
+    """Waits for changes in the directories of files with inotify. Falls back to polling with backoff."""
+
+    def __init__(self, paths):
+        self.fd = None
+        self.delay = 0.0
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1')
+            # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+            for directory in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+                if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+            self.fd = fd
+        except (OSError, AttributeError, TypeError) as exc:
+            LOGGER.debug('follow: inotify is not available, polling: %s', exc)
+
+    def wait(self, changed):
+        import time
+        if self.fd is None:
+            self.delay = 0.0 if changed else min(FOLLOW_TIMEOUT, self.delay * 2 or 0.01)
+            time.sleep(self.delay)
+            return
+        if changed:
+            return
+        import select
+        select.select([self.fd], [], [], FOLLOW_TIMEOUT)
+        try:
+            while os.read(self.fd, 1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+
+def _follow_files_blocks(paths, block_size, max_line_size):
+    global filename
+    encoding, errors = sys.stdin.encoding or 'utf-8', sys.stdin.errors or 'strict'
+    files = [_FollowedFile(path, encoding, errors) for path in paths]
+    watcher = _Watcher(paths)
+    try:
+        while True:
+            changed = False
+            for file in files:
+                lines = file.read(block_size, max_line_size)
+                if lines:
+                    changed = True
+                    filename = file.path
+                    yield lines
+            watcher.wait(changed)
+    finally:
+        for file in files:
+            file.close()
+
+def follow_files(paths, block_size=BLOCK_SIZE, max_line_size=MAX_LINE_SIZE, profile=None):
+    """Yield lines appended to `paths`, forever. Waits for new lines without busy polling."""
+    blocks = _follow_files_blocks(paths, block_size, max_line_size)
+    if profile is not None:
+        blocks = profile.timed_blocks(blocks)
+    return itertools.chain.from_iterable(blocks)
+
+def read_files(paths, block_size=BLOCK_SIZE, profile=None):
+    """Like `read_lines()` for a list of files. `-` is stdin.
+
+    Compressed files are decompressed, the next files are read in background
+    threads. The `filename` global is the name of the file of the current line.
+    """
+    blocks = _read_files_blocks(paths, block_size)
+    if profile is not None:
+        blocks = profile.timed_blocks(blocks)
+    return itertools.chain.from_iterable(blocks)
+
+class Output:
+    """Collects printed text and writes it to `stream` by big chunks.
+
+    `print` of the generated code is bound to `Output.print`, so the common
+    `print(...)` call only appends a string to the buffer.
+    """
+    def __init__(self, stream, buffer_size=OUTPUT_BUFFER_SIZE, line_buffered=False):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.line_buffered = line_buffered
+        self._parts = []
+        self._size = 0
+
+    def print(self, *args, sep=' ', end='\n', file=None, flush=False):
+        if file is not None and file is not self.stream:
+            return builtins.print(*args, sep=sep, end=end, file=file, flush=flush)
+        if len(args) == 1 and type(args[0]) is str:
+            text = args[0] + (end if end is not None else '\n')
+        else:
+            text = (sep if sep is not None else ' ').join(map(str, args)) + (end if end is not None else '\n')
+        self.write(text)
+        if flush:
+            self.flush()
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self.line_buffered or self._size >= self.buffer_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._parts:
+            data = ''.join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self.stream.write(data)
+        self.stream.flush()
+
+    def take(self):
+        data = ''.join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        return data
+
+class JsonLines:
+    """Decoder and encoder of the `--jsonl` mode. Malformed lines are counted and skipped."""
+
+    def __init__(self, output):
+        import json
+        self.output = output
+        self.loads = json.JSONDecoder().decode
+        self.dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        self.bad_lines = 0
+
+    def skip(self, line, exc):
+        if not line.strip():
+            return
+        self.bad_lines += 1
+        LOGGER.debug('malformed JSON line %r: %s', line[:80], exc)
+
+    def emit(self, *records):
+        """Write `records` as JSON lines. The output buffer writes them by big chunks."""
+        dumps = self.dumps
+        self.output.write(''.join(dumps(record) + '\n' for record in records))
+
+    def report(self):
+        if self.bad_lines:
+            LOGGER.warning('%s malformed JSON lines skipped', self.bad_lines)
+
+class Profile:
+    """Statistics of the `--profile` mode.
+
+    The generated code adds the time between actions to `times` and counts
+    calls in `calls`, by the action index. Lines out of groups are counted
+    by `counted()`, the reader and the writer time by the wrappers below.
+    """
+    def __init__(self, groups):
+        import time
+        self.clock = time.perf_counter
+        self.start = self.clock()
+        self.groups = groups
+        size = sum(len(actions) for _, actions in groups)
+        self.times = [0.0] * size
+        self.calls = [0] * size
+        self.lines_out = {}
+        self.read_time = self.write_time = 0.0
+        self.read_lines = 0
+
+    def timed_blocks(self, blocks):
+        clock = self.clock
+        while True:
+            start = clock()
+            block = next(blocks, None)
+            self.read_time += clock() - start
+            if block is None:
+                return
+            self.read_lines += len(block)
+            yield block
+
+    def timed_flush(self, flush):
+        def timed_flush():
+            start = self.clock()
+            try:
+                flush()
+            finally:
+                self.write_time += self.clock() - start
+        return timed_flush
+
+    def counted(self, stream, name):
+        lines_out = self.lines_out
+        lines_out[name] = 0
+        for line in stream:
+            lines_out[name] += 1
+            yield line
+
+    def stats(self):
+        index = itertools.count()
+        lines_in = self.read_lines
+        groups = []
+        for name, actions in self.groups:
+            lines_out = self.lines_out.get(name)
+            groups.append({
+                'name': name, 'lines_in': lines_in, 'lines_out': lines_out,
+                'actions': [{'action': action, 'calls': self.calls[i], 'time': self.times[i]}
+                            for action, i in zip(actions, index)]})
+            lines_in = lines_out
+        return {
+            'time': self.clock() - self.start,
+            'read': {'time': self.read_time, 'lines': self.read_lines},
+            'write': {'time': self.write_time},
+            'groups': groups}
+
+    def report(self, fp, format='text'):
+        stats = self.stats()
+        if format == 'json':
+            import json
+            fp.write(json.dumps(stats) + '\n')
+            return
+        total = stats['time'] or 1e-9
+        fp.write('# profile: {:.3f}s total, read {:.3f}s ({} lines), write {:.3f}s\n'.format(
+            stats['time'], stats['read']['time'], stats['read']['lines'], stats['write']['time']))
+        fp.write('{:<16} {:>10} {:>10} {:>10} {:>9} {:>6}  {}\n'.format(
+            'group', 'lines in', 'lines out', 'calls', 'time', '%', 'action'))
+        for group in stats['groups']:
+            name, lines_in, lines_out = group['name'], group['lines_in'], group['lines_out']
+            lines_out = '-' if lines_out is None else lines_out
+            for action in group['actions']:
+                fp.write('{:<16} {:>10} {:>10} {:>10} {:>8.3f}s {:>5.1f}%  {}\n'.format(
+                    name, lines_in, lines_out, action['calls'], action['time'],
+                    100 * action['time'] / total, action['action']))
+                name = lines_in = lines_out = ''
+        fp.flush()
+
+def batches(stream, size=BATCH_SIZE, array=False):
+    """Split `stream` to lists of `size` items, or to NumPy arrays if `array` is true."""
+    if array:
+        try:
+            import numpy
+        except ImportError:
+            LOGGER.warning('NumPy is not installed, `batch` is a list')
+            array = False
+    while True:
+        batch = list(itertools.islice(stream, size))
+        if not batch:
+            return
+        yield numpy.array(batch) if array else batch
+
+class Aggregator:
+    """One streaming aggregate for `aggregate()`. `key` maps an item to the aggregated value."""
+
+    def __init__(self, key=None):
+        self.key = key
+
+    def add(self, value):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+class Count(Aggregator):
+    """Number of items, or of items with a true `key(item)`."""
+
+    def __init__(self, key=None):
+        super().__init__(key)
+        self.count = 0
+
+    def add(self, value):
+        if self.key is None or value:
+            self.count += 1
+
+    def result(self):
+        return self.count
+
+class Sum(Aggregator):
+    def __init__(self, key=None, start=0):
+        super().__init__(key)
+        self.total = start
+
+    def add(self, value):
+        self.total += value
+
+    def result(self):
+        return self.total
+
+class Min(Aggregator):
+    """The smallest value, None for an empty stream."""
+
+    def __init__(self, key=None):
+        super().__init__(key)
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+class Max(Min):
+    """The largest value, None for an empty stream."""
+
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+class Mean(Aggregator):
+    """The arithmetic mean, None for an empty stream."""
+
+    def __init__(self, key=None):
+        super().__init__(key)
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+class Distinct(Aggregator):
+    """Number of distinct values.
+
+    It is exact up to `exact` values. After that the values are forgotten and
+    the HyperLogLog sketch with 2 ** `precision` registers estimates it
+    (the standard error is 1.04 / sqrt(2 ** precision), ~0.8% by default).
+    """
+
+    def __init__(self, key=None, precision=14, exact=1 << 14):
+        super().__init__(key)
+        self.precision = precision
+        self.exact = exact
+        self.values = set()
+        self.registers = None
+
+    def add(self, value):
+        if self.registers is None:
+            self.values.add(value)
+            if len(self.values) > self.exact:
+                self.registers = bytearray(1 << self.precision)
+                for value in self.values:
+                    self._add_hash(value)
+                self.values = None
+        else:
+            self._add_hash(value)
+
+    def _add_hash(self, value):
+        # `hash()` of small ints is the int itself, mix the bits (splitmix64 finalizer)
+        h = hash(value) & 0xffffffffffffffff
+        h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+        h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+        h ^= h >> 31
+        p = self.precision
+        index = h & ((1 << p) - 1)
+        rank = 64 - p - (h >> p).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def result(self):
+        if self.registers is None:
+            return len(self.values)
+        import math
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+class TopK(Aggregator):
+    """The `k` most common values with their counts, like `Counter.most_common(k)`.
+
+    At most 2 * `capacity` counters are kept: the least common half is dropped
+    when they are full. So it is exact while there are fewer distinct values,
+    after that the counts are lower bounds of the heavy hitters.
+    """
+
+    def __init__(self, k=10, key=None, capacity=None):
+        super().__init__(key)
+        self.k = k
+        self.capacity = capacity or max(1000, 10 * k)
+        self.counts = {}
+
+    def add(self, value):
+        counts = self.counts
+        counts[value] = counts.get(value, 0) + 1
+        if len(counts) >= 2 * self.capacity:
+            import heapq
+            self.counts = dict(heapq.nlargest(self.capacity, counts.items(), key=lambda x: x[1]))
+
+    def result(self):
+        import heapq
+        return heapq.nlargest(self.k, self.counts.items(), key=lambda x: x[1])
+
+class Quantile(Aggregator):
+    """The `q` quantile (or a list of them if `q` is a sequence).
+
+    It is computed over a uniform random sample of `size` values
+    (reservoir sampling, algorithm L), so it is exact for shorter streams.
+    """
+
+    def __init__(self, q=0.5, key=None, size=10000, seed=None):
+        import random
+        import math
+        super().__init__(key)
+        self.q = q
+        self.size = size
+        self.sample = []
+        self._random = random.Random(seed)
+        self._log = math.log
+        self._w = 1.0
+        self._skip = 0
+
+    def add(self, value):
+        sample = self.sample
+        if len(sample) < self.size:
+            sample.append(value)
+            if len(sample) == self.size:
+                self._next_skip()
+        elif self._skip:
+            self._skip -= 1
+        else:
+            sample[self._random.randrange(self.size)] = value
+            self._next_skip()
+
+    def _next_skip(self):
+        rnd, log = self._random.random, self._log
+        self._w *= (1.0 - rnd()) ** (1.0 / self.size)
+        self._skip = int(log(1.0 - rnd()) / log(1.0 - self._w))
+
+    def result(self):
+        sample = sorted(self.sample)
+        if not sample:
+            return None
+        quantile = lambda q: sample[min(len(sample) - 1, int(q * len(sample)))]
+        if isinstance(self.q, (int, float)):
+            return quantile(self.q)
+        return [quantile(q) for q in self.q]
+
+def aggregate(stream, **aggregators):
+    """Compute all `aggregators` in one pass over `stream`.
+
+    Returns a namespace with the results by the names of the keyword arguments:
+
+        stats = aggregate(stream, total=Sum(int), longest=Max(len), words=Distinct())
+        print(stats.total, stats.longest, stats.words)
+    """
+    import types
+    steps = [(agg.add, agg.key) for agg in aggregators.values()]
+    for item in stream:
+        for add, key in steps:
+            add(item if key is None else key(item))
+    return types.SimpleNamespace(**{name: agg.result() for name, agg in aggregators.items()})
+
+def _spill(items):
+    import pickle
+    import tempfile
+    fp = tempfile.TemporaryFile()
+    items = iter(items)
+    for chunk in iter(lambda: list(itertools.islice(items, 1024)), []):
+        pickle.dump(chunk, fp, pickle.HIGHEST_PROTOCOL)
+    fp.seek(0)
+    return fp
+
+def _read_run(fp):
+    import pickle
+    with fp:
+        while True:
+            try:
+                chunk = pickle.load(fp)
+            except EOFError:
+                return
+            yield from chunk
+
+def sort(stream, key=None, reverse=False, memory=None):
+    """Sort `stream` like `sorted()`, but with a memory budget (default: --sort-memory).
+
+    Sorted runs which do not fit in `memory` bytes are spilled to temporary
+    files and merged at the end. The sort is stable.
+    """
+    import heapq
+    memory = memory or SORT_MEMORY
+    getsizeof = sys.getsizeof
+    runs, items, size = [], [], 0
+    for item in stream:
+        items.append(item)
+        size += getsizeof(item) + 8
+        if size > memory:
+            items.sort(key=key, reverse=reverse)
+            runs.append(_spill(items))
+            items, size = [], 0
+            if len(runs) == SORT_MERGE_WIDTH:
+                # do not run out of file descriptors, merge runs to one bigger run
+                runs = [_spill(heapq.merge(*map(_read_run, runs), key=key, reverse=reverse))]
+    items.sort(key=key, reverse=reverse)
+    if runs:
+        LOGGER.debug('sort: merge %s spilled runs', len(runs))
+        yield from heapq.merge(*map(_read_run, runs), items, key=key, reverse=reverse)
+    else:
+        yield from items
+
+def uniq(stream, key=None, count=False):
+    """Drop adjacent duplicates like `uniq`. Yields (count, item) pairs if `count` is true, like `uniq -c`."""
+    for _, group in itertools.groupby(stream, key):
+        item = next(group)
+        yield (1 + sum(1 for _ in group), item) if count else item
+
+def group_by(stream, key=None, memory=None):
+    """Sort `stream` by `key` with `sort()` and yield (key, group iterator) pairs like `itertools.groupby()`."""
+    return itertools.groupby(sort(stream, key, memory=memory), key)
+
+def _parallel_init():
+    # the forked worker has a copy of the parent output buffer; it is not ours
+    output.take()
+    output.buffer_size = float('inf')
+    output.line_buffered = False
+
+def _parallel_worker(func_name, batch):
+    lines = list(globals()[func_name](iter(batch)))
+    return lines, output.take()
+
+def parallel(process, stream, jobs, batch_size=PARALLEL_BATCH_SIZE):
+    """Run the `process` element group over batches of `stream` in `jobs` worker processes.
+
+    Yielded lines and printed text come back in the input order. Workers are
+    forked, so each of them has its own copy of the global variables.
+    """
+    import multiprocessing
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        LOGGER.warning('parallel processing requires fork() support, run in a single process')
+        yield from process(stream)
+        return
+    batches = iter(lambda: list(itertools.islice(stream, batch_size)), [])
+    pending = deque()
+    with multiprocessing.get_context('fork').Pool(jobs, _parallel_init) as pool:
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                pending.append(pool.apply_async(_parallel_worker, (process.__name__, batch)))
+            while pending and (batch is None or len(pending) > 2 * jobs or pending[0].ready()):
+                lines, text = pending.popleft().get()
+                if text:
+                    output.write(text)
+                yield from lines
+
+def _cache_ident(argv):
+    # like `__pycache__`, the entry is stale if py3line itself was changed
+    return repr((__version__, os.stat(__file__).st_mtime_ns, sys.version, argv))
+
+def _cache_key(argv):
+    return '{:08x}'.format(binascii.crc32(_cache_ident(argv).encode('utf-8')))
+
+def _cache_load(key, argv):
+    import types
+    path = os.path.join(CACHE_DIR, key + '.pyc')
+    try:
+        with open(path, 'rb') as fp:
+            ident, options, code, compiled = marshal.load(fp)
+        if ident != _cache_ident(argv):
+            return None
+        os.utime(path)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return types.SimpleNamespace(**options), code, compiled
+
+def _cache_evict():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        st = entry.stat()
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_SIZE:
+            break
+        LOGGER.debug('compile cache evict: %s', path)
+        os.unlink(path)
+        total -= size
+
+def _cache_store(key, argv, args, code):
+    """Compile `code` and save it like `__pycache__` does. Returns None if it is not possible.
+
+    The source is saved with the code object, so tracebacks can show it.
+    """
+    path = os.path.join(CACHE_DIR, key + '.pyc')
     try:
-        with tempfile.NamedTemporaryFile(prefix='py3_', delete=False) as fp:
-            fp.write(data.encode('utf-8'))
-        return fp.name
-    except Exception as exc:
-        LOGGER.debug('write to tmp.py error: %s', exc)
+        compiled = compile(code, SOURCE_NAME, 'exec')
+    except SyntaxError:
+        return None  # let execute() report it
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            marshal.dump((_cache_ident(argv), vars(args), code, compiled), fp)
+        os.replace(tmp_path, path)
+        _cache_evict()
+    except OSError as exc:
+        LOGGER.debug('compile cache store error: %s', exc)
         return None
+    return compiled
+
+def _format_exception(code, etype, exc, tb):
+    import linecache
+    # the generated code is never written to disk, give its source to tracebacks here
+    linecache.cache[SOURCE_NAME] = (len(code), None, code.splitlines(True), SOURCE_NAME)
+    tb_offset = 1
+    try:
+        import IPython.core.ultratb
+        itb = IPython.core.ultratb.VerboseTB(include_vars=False)
+        return itb.text(etype, exc, tb, tb_offset=tb_offset)
+    except Exception as exc2:
+        LOGGER.debug('exec() error handler extension: %s', exc2)
+        import traceback
+        trace = ['Traceback (most recent call last):\n']
+        trace += traceback.extract_tb(tb).format()[tb_offset:]
+        trace += traceback.format_exception_only(etype, exc)
+        return ''.join(trace)
 
-def execute(code):
+def execute(code, compiled=None):
     exit_code = 0
     try:
-        name = _try_to_write_to_tmp_py_file(code) or "<string>"
-        LOGGER.debug('write to tmp.py: %s', name)
+        exec(compiled or compile(code, SOURCE_NAME, 'exec'), globals())
+    except Exception:
+        LOGGER.error(_format_exception(code, *sys.exc_info()))
+        exit_code = 1
+    return exit_code
+
+def _send_request(sock, argv):
+    import array
+    import socket
+    data = marshal.dumps((argv, dict(os.environ), os.getcwd()))
+    fds = array.array('i', [0, 1, 2])
+    sock.sendmsg([len(data).to_bytes(8, 'big')], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    sock.sendall(data)
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+def _recv_request(sock):
+    import array
+    import socket
+    fds = array.array('i')
+    header, ancdata, _, _ = sock.recvmsg(8, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(header) < 8:
+        header += _recv_exactly(sock, 8 - len(header))
+    argv, env, cwd = marshal.loads(_recv_exactly(sock, int.from_bytes(header, 'big')))
+    return list(fds), argv, env, cwd
+
+def run_client(path, argv):
+    """Run `argv` in the `--serve` daemon listening on `path`. Returns None if it is not running.
+
+    stdin, stdout and stderr are passed to the daemon, so the output goes
+    directly to them. The environment and the working directory are sent too.
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as exc:
+        LOGGER.debug('daemon %s is not available: %s', path, exc)
+        sock.close()
+        return None
+    with sock:
+        _send_request(sock, argv)
         try:
-            exec(compile(code, name, 'exec'), globals())
-        except Exception:
-            etype, exc, tb = sys.exc_info()
-            tb_offset = 1
+            return int.from_bytes(_recv_exactly(sock, 4), 'big', signed=True)
+        except EOFError:
+            LOGGER.error('daemon %s: the request is terminated', path)
+            return 1
+
+def _serve_request(conn):
+    import signal
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    code = 1
+    try:
+        fds, argv, env, cwd = _recv_request(conn)
+        for fd, target in zip(fds, (0, 1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(cwd)
+        global CACHE_DIR
+        CACHE_DIR = os.environ.get('PY3LINE_CACHE_DIR') or os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), NAME)
+        code = main(argv)
+    except SystemExit as exc:
+        code = exc.code if isinstance(exc.code, int) else exc.code is not None
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
             try:
-                import IPython.core.ultratb
-                itb = IPython.core.ultratb.VerboseTB(include_vars=False)
-                trace_text = itb.text(etype, exc, tb, tb_offset=tb_offset)
-            except Exception as exc2:
-                LOGGER.debug('exec() error handler extension: %s', exc2)
-                trace = ['Traceback (most recent call last):\n']
-                trace += traceback.extract_tb(tb).format()[tb_offset:]
-                trace += traceback.format_exception_only(etype, exc)
-                trace_text = ''.join(trace)
-                trace_text = trace_text.replace(name, "<string>")
-            LOGGER.error(trace_text)
-            exit_code = 1
+                stream.flush()
+            except Exception:
+                pass
+        try:
+            conn.sendall(int(code).to_bytes(4, 'big', signed=True))
+        finally:
+            os._exit(code)
+
+def serve(path):
+    """Listen on the `path` Unix socket and run every request in a forked process.
+
+    The daemon has `argparse`, `ast` and `DEFAULT_MODULES` imported already. Every
+    request is executed in a fork, so it has its own copy of the global variables,
+    like a new py3line process.
+    """
+    import importlib
+    import signal
+    import socket
+    for module in sorted(DEFAULT_MODULES) + ['ast', 'argparse', 'logging', 'traceback', 'json']:
+        globals()[module] = importlib.import_module(module)
+    parseargs([])
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # reap children automatically
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(128)
+        LOGGER.debug('serve on %s', path)
+        while True:
+            conn, _ = sock.accept()
+            if os.fork() == 0:
+                sock.close()
+                _serve_request(conn)
+            conn.close()
+    except KeyboardInterrupt:
+        return 0
     finally:
-        if os.path.exists(name):
-            LOGGER.debug('remove tmp.py: %s', name)
-            os.unlink(name)
-    return exit_code
+        sock.close()
+        os.unlink(path)
 
-def main():
-    args = parseargs()
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    daemon = os.environ.get('PY3LINE_SOCKET')
+    if daemon and '--serve' not in argv:
+        code = run_client(daemon, argv)
+        if code is not None:
+            return code
+    # the cache is looked up by raw arguments, so a hit does not even need `argparse`
+    key = _cache_key(argv) if '--no-cache' not in argv else None
+    cached = key and _cache_load(key, argv)
+    if cached:
+        args, code, compiled = cached
+    else:
+        args = parseargs(argv)
     setup_logger(args)
     LOGGER.debug('arguments: %r', args)
 
-    expressions = [
-        z.strip() for x in args.expressions
-        for z in x.split(';') if z.strip()]
-    modules = set()
+    if cached:
+        LOGGER.debug('compile cache hit: %s', key)
+    else:
+        expressions = [
+            z.strip() for x in args.expressions
+            for z in x.split(';') if z.strip()]
+        modules = set()
 
-    actions, variables, used_variables = _preprocess_expressions(expressions)
-    code = _codegen(actions, variables, used_variables, modules)
+        actions, variables, used_variables = _preprocess_expressions(expressions, args.jsonl)
+        code = _codegen(actions, variables, used_variables, modules, args)
+        compiled = _cache_store(key, argv, args, code) if key and args.cache and code else None
 
-    if args.pycode:
+    if args.serve:
+        return serve(args.serve)
+    elif args.pycode:
         print(code)
     elif args.version:
         print(__version__)
     else:
-        return execute(code)
+        return execute(code, compiled)
     return 0
 
 
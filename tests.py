@@ -7,10 +7,13 @@ import shlex
 import os.path
 from pathlib import Path
 import re
+import json
+import time
 
-from py3line import to_tokens, get_names, Py3LineSyntaxError
+from py3line import to_tokens, get_names, Py3LineSyntaxError, _preprocess_expressions, _codegen, parseargs
+from py3line import sort, uniq, group_by, aggregate, Count, Sum, Min, Max, Mean, Distinct, TopK, Quantile
 
-Py3LineCase = lambda *args, full_check=True, code=0: namedtuple('Py3LineCase', 'actions, input, output, full_check, code')(*args, full_check, code)
+Py3LineCase = lambda *args, full_check=True, code=0, options='': namedtuple('Py3LineCase', 'actions, input, output, full_check, code, options')(*args, full_check, code, options)
 PyCodeCase = lambda *args, assert_get_names=None: namedtuple('PyCodePy3LineCase', 'code, exception, tokens, assert_get_names')(*args, assert_get_names)
 PY3LINE = './py3line.py'
 ROOT = Path(os.path.dirname(__file__))
@@ -125,6 +128,74 @@ PY3LINE_TESTS = [
         (ROOT/'testsuit'/'test.txt').open().read().split('\n'),
         "This cat,\nwhose Betty.\nThis dog,\nwhose Frank.\nThis fish,\nwhose George.\nThis goat,\nwhose Adam.".split('\n')),
 
+    # printf "a\r\nb\r\n\r\nc" | ./py3line.py "print(repr(line))"
+    Py3LineCase(
+        ['print(repr(line))'],
+        ['a\r', 'b\r', '\r', 'c'],
+        ["'a'", "'b'", "''", "'c'"]),
+    Py3LineCase(
+        ['print(line, line, sep="-", end="|\\n")', 'output.write(line + "!\\n")'],
+        ['a', 'b'],
+        ['a-a|', 'a!', 'b-b|', 'b!']),
+    # ./py3line.py -j 3 "x = int(line); if x % 3: continue; print(x); line = x * 2; print(sum(stream))"
+    Py3LineCase(
+        "x = int(line); if x % 3: continue; print(x); line = x * 2; print(sum(stream))".split(';'),
+        list(map(str, range(5000))),
+        list(map(str, range(0, 5000, 3))) + [str(sum(range(0, 5000, 3)) * 2)],
+        options='-j 3'),
+    # cat ./testsuit/test.txt | ./py3line.py "line = re.findall(r' is ([A-Z]\w*)', line); if not line: continue; print(*line)"
+    Py3LineCase(
+        [r"line = re.findall(r' is ([A-Z]\w*)', line)", "if not line: continue", "print(*line)"],
+        (ROOT/'testsuit'/'test.txt').open().read().split('\n'),
+        ['Betty', 'Frank', 'George', 'Adam']),
+    # printf "a:b:c\nd:e:f" | ./py3line.py -F : "print(fields[2], *fields[:2])"
+    Py3LineCase(
+        ['print(fields[2], *fields[:2])'],
+        ['a:b:c', 'd:e:f'],
+        ['c a b', 'f d e'],
+        options='-F :'),
+    Py3LineCase(
+        ['print(fields[0], len(fields))'],
+        ['  a  b c', 'd'],
+        ['a 3', 'd 1']),
+    Py3LineCase(
+        ['print(fields[1])'],
+        ['a, b,c', 'd,e'],
+        ['b', 'e'],
+        options="-F ', *'"),
+    # seq 1 10 | ./py3line.py --batch-size 4 "batch = [int(x) * 2 for x in batch]; print(len(batch)); print(line)"
+    Py3LineCase(
+        "batch = [int(x) * 2 for x in batch]; print(len(batch)); print(line)".split(';'),
+        list(map(str, range(1, 11))),
+        "4 2 4 6 8 4 10 12 14 16 2 18 20".split(),
+        options='--batch-size 4'),
+    Py3LineCase(
+        ["c = collections.Counter()", "c.update(x for line in batch for x in line.split())",
+         "for line in stream: pass", "print(c.most_common(2))"],
+        ['a b', 'b c', 'b'],
+        ["[('b', 3), ('a', 1)]"]),
+    Py3LineCase(
+        ["line = len(line.split())", "s = aggregate(stream, total=Sum(), top=Max())", "print(s.total, s.top)"],
+        ['Here are', 'some', 'words for you.'],
+        ['6 3']),
+    # printf "b\na\nb\nc\nb" | ./py3line.py --sort-memory 1 "for n, x in uniq(sort(stream), count=True): print(n, x)"
+    Py3LineCase(
+        ["for n, x in uniq(sort(stream), count=True): print(n, x)"],
+        ['b', 'a', 'b', 'c', 'b'],
+        ['1 a', '3 b', '1 c'],
+        options='--sort-memory 1'),
+    # printf '{"a": 1}\nbad\n{"a": 2}' | ./py3line.py --jsonl "record['a'] += 1; emit(record)"
+    Py3LineCase(
+        ["record['a'] += 1", "emit(record, {'line': line})"],
+        ['{"a": 1}', 'bad', '', '{"a": 2.5}'],
+        ['{"a":2}', '{"line":"{\\"a\\": 1}"}', '{"a":3.5}', '1 malformed JSON lines skipped'],
+        full_check=False, options='--jsonl'),
+    # more than one read block with multibyte chars on block boundaries
+    Py3LineCase(
+        "line = len(line); stream = list(stream); print(len(stream), sum(stream))".split(';'),
+        ['строка номер {}'.format(x) for x in range(200000)],
+        ['200000 3688890']),
+
 ]
 
 PYCODE_TESTS = [
@@ -235,7 +306,7 @@ def _dump(tokens):
 def test_py3line_cases(case):
     with tempfile.NamedTemporaryFile(delete=False) as f:
         f.write('\n'.join(case.input).encode('utf-8')); f.flush();
-        command = 'cat {0} | {1} {2}'.format(f.name, PY3LINE, shlex.quote('; '.join(case.actions)))
+        command = 'cat {0} | {1} {3} {2}'.format(f.name, PY3LINE, shlex.quote('; '.join(case.actions)), case.options)
         print(command)
         code, text = subprocess.getstatusoutput(command)
         output = ANSI_ESCAPE.sub('', text).split('\n')
@@ -246,6 +317,134 @@ def test_py3line_cases(case):
                 assert any(line in out for out in output)
         assert code == case.code
 
+@pytest.mark.parametrize("case", PY3LINE_TESTS)
+def test_py3line_cases_from_regular_file(case):
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write('\n'.join(case.input).encode('utf-8')); f.flush();
+        command = '{1} {3} {2} < {0}'.format(f.name, PY3LINE, shlex.quote('; '.join(case.actions)), case.options)
+        code, text = subprocess.getstatusoutput(command)
+        output = ANSI_ESCAPE.sub('', text).split('\n')
+        if case.full_check:
+            assert output == case.output
+        else:
+            for line in case.output:
+                assert any(line in out for out in output)
+        assert code == case.code
+
+def _pycode(*expressions):
+    return _codegen(*_preprocess_expressions(expressions), set())
+
+def test_codegen_shares_only_cross_group_variables():
+    code = _pycode('s = 0', 'x = line.split()', 's += len(x)', 'for line in stream: pass', 'print(s)')
+    assert code.count('global s\n') == 3
+    assert 'global s, x' not in code
+    assert 'global' not in _pycode('x = line.split()', 'print(x)')
+
+def test_codegen_loops_over_stream_in_last_element_group():
+    code = _pycode('x = line.split()', 'print(x)')
+    assert 'yield line' not in code
+    assert 'for line in stream: pass' not in code
+    assert 'yield line' in _pycode('x = line.split()', 'yield x')
+
+def test_codegen_splits_only_used_fields():
+    assert 'fields = line.split(None, 2)' in _pycode('x = line', 'print(fields[0], fields[1])')
+    assert 'fields = line.split()' in _pycode('print(fields[-1])')
+    assert _pycode('fields = line.split()', 'print(fields[1])').count('fields = line.split') == 1
+    assert 'fields' not in _pycode('print(line)')
+
+def test_codegen_decodes_record_only_if_it_is_used():
+    code = _codegen(*_preprocess_expressions(['x = 1', 'y = line', "print(record['a'])"], jsonl=True), set(), parseargs(['--jsonl']))
+    assert code.index('y = line') < code.index('record = _loads(line)') < code.index("print(record['a'])")
+    code = _codegen(*_preprocess_expressions(['print(line)'], jsonl=True), set(), parseargs(['--jsonl']))
+    assert '_loads' not in code and 'emit = _jsonl.emit' in code
+
+def test_codegen_hoists_loop_invariants():
+    code = _pycode("x = re.findall(r'\\w+', line, flags=re.I)", "print(x, {'a': 1}[line])")
+    assert "_re1 = re.compile('\\\\w+', re.I)" in code
+    assert 'x = _re1.findall(line)' in code
+    assert "_const2 = {'a': 1}" in code
+    code = _pycode("re = my_module", "print(re.findall('x', line), re.findall(line, 'x'))")
+    assert 're.compile' not in code
+
+def test_aggregate_in_one_pass():
+    s = aggregate(iter(range(10)), n=Count(), odd=Count(lambda x: x % 2), total=Sum(), low=Min(),
+                  high=Max(str), avg=Mean(), distinct=Distinct(lambda x: x // 2), top=TopK(1, lambda x: x // 4),
+                  median=Quantile(0.5), quantiles=Quantile([0.1, 0.9]))
+    assert (s.n, s.odd, s.total, s.low, s.high, s.avg) == (10, 5, 45, 0, '9', 4.5)
+    assert (s.distinct, s.top, s.median, s.quantiles) == (5, [(0, 4)], 5, [1, 9])
+    assert vars(aggregate(iter([]), low=Min(), avg=Mean(), median=Quantile())) == {'low': None, 'avg': None, 'median': None}
+
+def test_aggregate_sketches_have_bounded_memory():
+    distinct, top, median = Distinct(), TopK(1, capacity=100), Quantile(0.5, size=1000, seed=1)
+    aggregate((x % 50000 if x % 3 else 0 for x in range(200000)), distinct=distinct, top=top, median=median)
+    assert distinct.values is None and abs(distinct.result() - 50000) < 50000 * 0.05
+    assert top.result()[0][0] == 0 and len(top.counts) < 200
+    assert len(median.sample) == 1000 and abs(median.result() - 12500) < 2500
+
+def test_sort_spills_to_temporary_files(tmpdir, monkeypatch):
+    import tempfile
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    items = [(x * 7919 % 1000, x) for x in range(5000)]
+    assert list(sort(iter(items), key=lambda x: x[0], memory=1000)) == sorted(items, key=lambda x: x[0])
+    assert list(sort(iter(items), reverse=True, memory=1000)) == sorted(items, reverse=True)
+    assert list(sort(iter(items))) == sorted(items)
+    assert list(uniq(iter('aabca'))) == ['a', 'b', 'c', 'a']
+    groups = group_by(iter(range(10)), key=lambda x: x % 3, memory=100)
+    assert [(k, list(g)) for k, g in groups] == [(0, [0, 3, 6, 9]), (1, [1, 4, 7]), (2, [2, 5, 8])]
+    assert tmpdir.listdir() == []
+
+def test_py3line_profile():
+    command = 'printf "1\\n2\\n3" | {0} --no-cache --profile-json "x = int(line); if x > 2: continue; print(x); for line in stream: pass; print(1)" 2>&1 >/dev/null'
+    stats = json.loads(subprocess.getoutput(command.format(PY3LINE)))
+    assert stats['read']['lines'] == 3
+    process, transform = stats['groups']
+    assert (process['name'], process['lines_in'], process['lines_out']) == ('process1', 3, 2)
+    assert [(a['action'], a['calls']) for a in process['actions']] == [('x = int(line)', 3), ('if x > 2: continue', 3), ('print(x)', 2)]
+    assert (transform['lines_in'], transform['actions'][1]['calls']) == (2, 1)
+    assert '_pcalls' not in _pycode('print(line)')
+
+def test_py3line_input_files(tmpdir):
+    import gzip, bz2, lzma
+    tmpdir.join('a.txt').write('1\n2')
+    for i, module in enumerate([gzip, bz2, lzma], 3):
+        with module.open(str(tmpdir.join('b{}'.format(i))), 'wt') as fp:
+            fp.write('{}\n'.format(i))
+    command = 'cd {0} && echo 0 | {1} "print(filename, line)" -i a.txt b3 b4 b5 -'.format(tmpdir, os.path.abspath(PY3LINE))
+    assert subprocess.getstatusoutput(command) == (0, 'a.txt 1\na.txt 2\nb3 3\nb4 4\nb5 5\n- 0')
+    assert subprocess.getstatusoutput('echo 0 | {0} "print(filename, line)"'.format(PY3LINE)) == (0, '- 0')
+
+def test_py3line_follow(tmpdir):
+    log = tmpdir.join('log')
+    log.write('old\n')
+    command = [PY3LINE, '--no-cache', '-f', 'if "x" in line: print(line)', '-i', str(log)]
+    with subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True) as proc:
+        try:
+            time.sleep(0.5)
+            with log.open('a') as fp:
+                fp.write('1x\n2\n3')
+            assert proc.stdout.readline() == '1x\n'
+            log.rename(tmpdir.join('log.1'))
+            log.write('4x\n')
+            assert proc.stdout.readline() == '4x\n'
+        finally:
+            proc.kill()
+
+def test_py3line_compile_cache(tmpdir):
+    command = 'printf "a b\\nc d" | PY3LINE_CACHE_DIR={0} {1} {2} "x = line.split(); print(x[1])"'
+    assert subprocess.getstatusoutput(command.format(tmpdir, PY3LINE, '--no-cache')) == (0, 'b\nd')
+    assert tmpdir.listdir() == []
+    assert subprocess.getstatusoutput(command.format(tmpdir, PY3LINE, '')) == (0, 'b\nd')
+    assert [x.ext for x in tmpdir.listdir()] == ['.pyc']
+    assert subprocess.getstatusoutput(command.format(tmpdir, PY3LINE, '')) == (0, 'b\nd')
+    assert len(tmpdir.listdir()) == 1
+
+def test_py3line_does_not_write_tmp_files(tmpdir):
+    command = 'echo 1 | TMPDIR={0} {1} --no-cache "print(line); print(1 / 0)"'.format(tmpdir, PY3LINE)
+    code, text = subprocess.getstatusoutput(command)
+    assert code == 1
+    assert 'print(1 / 0)' in ANSI_ESCAPE.sub('', text)
+    assert tmpdir.listdir() == []
+
 # @pytest.mark.skip
 @pytest.mark.parametrize("case", PYCODE_TESTS)
 def test_pycode_cases(case):